@@ -1,23 +1,32 @@
+import gc
 import time
+import micropython
 import rp2
+from micropython import const
+from array import array
 from rp2 import asm_pio, PIO, StateMachine
 from machine import Pin
 
 #
-# Output NeoPixel data via an out() pin.  Assumes that the data is in the upper 24 bits
+# Output NeoPixel data via a side-set pin.  Assumes that the data is in the upper 24 bits
 # of each word.
 # 
-# There is one output pin and one set pin, both the same pin number.  That allows the
-# code to use set() to output a constant value, and out() to output a variable value,
-# all on the same physical pin.
+# There is one side-set pin, which is the NeoPixel data line.  Every instruction sets
+# the output high or low via side-set, so the state machine shifts each data bit into
+# X and uses jmp() to choose the instruction that outputs it.
 #
-# Ideally, we would drive this with DMA, including the mandatory delay at the end
-# of data transmission.  As it is, the caller needs to send data to the FIFO fast
-# enough to keep up with the data transfer, and do a delay between updates of the
-# strip.
+# The data is fed to the FIFO by DMA (see show(), below), so the FIFO keeps up with
+# the data transfer without any help from Python.  The mandatory delay at the end
+# of data transmission is done by the state machine, too: it counts the pixels,
+# and after the last one it keeps the output low for 53us.  The number of pixels
+# (minus 1) must be the first word written to the FIFO after the state machine
+# starts.  It is kept in the ISR, which is otherwise unused.
 #
-# Assumes that the state machine is run at 4.8 MHz.  The loop is 6 cycles, which
-# means the entire loop executes at a rate of 800 kHz (4.8 MhZ / 6).
+# Assumes that the state machine is run at 2.4 MHz.  Each bit is 3 cycles, which
+# means bits are sent at a rate of 800 kHz (2.4 MhZ / 3).  The exception is the
+# last bit of each pixel: its low third is stretched by 2 cycles (jmp(y_dec) and
+# the pull() of the next pixel), so it is 5 cycles.  A pixel is 74 cycles; see
+# PIXEL_CYCLES, below.
 #
 # The NeoPixel protocol is a simple one wire serial protocol.  It is a series of
 # pulses with a frequency of 800 kHz.  Each bit is encoded as a single pulse.
@@ -30,36 +39,141 @@ from machine import Pin
 # is high (the start of the pulse).  During the middle third, the output is equal
 # to the data bit we are transmitting.  During the last third, the output is low
 # (end of the pulse).  This results in a 1 bit having a 2/3 duty cycle, and a 0
-# bit having a 1/3 duty cycle.
+# bit having a 1/3 duty cycle.  Each third is one cycle.  The last third of one
+# bit is spent getting the next bit from the OSR.
 #
-@asm_pio(out_init=PIO.OUT_LOW, autopull=True, pull_thresh=24, out_shiftdir=PIO.SHIFT_LEFT,
-         set_init=PIO.OUT_LOW, fifo_join=PIO.JOIN_TX)
+@asm_pio(sideset_init=PIO.OUT_LOW, pull_thresh=24, out_shiftdir=PIO.SHIFT_LEFT,
+         fifo_join=PIO.JOIN_TX)
 def neopixel_write():
+    # Get the number of pixels (minus 1), and save it for every frame
+    pull(block)                 .side(0)
+    mov(isr, osr)               .side(0)
+
+    # Y counts down the pixels remaining in this frame
+    label("frame")
+    mov(y, isr)                 .side(0)
+
+    label("pixel")
     # Wait for more data, while the output is low
-    pull(ifempty)
+    pull(block)                 .side(0)
+
+    label("bitloop")
+    # Get the data bit, while the output is low (the last third of the
+    # previous bit).
+    out(x, 1)                   .side(0)
 
     # Start the pulse by setting the output pin high.
-    # Delay 1/3 of the period.
-    set(pins, 1)[1]
+    jmp(not_x, "zero")          .side(1)
+
+    # A 1 bit continues the pulse.
+    # Loop until all 24 bits of the pixel have been sent.
+    jmp(not_osre, "bitloop")    .side(1)
+
+    # Loop until all of the pixels in the frame have been sent
+    wrap_target()
+    jmp(y_dec, "pixel")         .side(0)
+
+    # Keep the output low for 32 * 4 cycles (53us), so the pixels update
+    set(x, 31)                  .side(0)
+    label("latch")
+    jmp(x_dec, "latch")         .side(0) [3]
+    jmp("frame")                .side(0)
 
-    # Output the data bit.  In the case of a 1 bit, this will continue
-    # the pulse.  In the case of a 0 bit, it will end the pulse.
-    out(pins, 1)[1]
+    # A 0 bit ends the pulse.  After the last bit of a pixel, this wraps
+    # to the pixel loop above.  The wrap itself is free, so both 0 and 1
+    # bits reach jmp(y_dec) at the same time, and the last bit of every
+    # pixel has the same 2-cycle longer low third.
+    label("zero")
+    jmp(not_osre, "bitloop")    .side(0)
+    wrap()
 
-    # Set the output low.  If the data bit was 1, this ends the pulse.
-    # If the data bit was 0, this just keeps the output low.
-    set(pins, 0)
+NUM_LEDS = const(90)
 
 #
 # NOTE: The NeoPixel data pin is attached to the Pico's pin 12.
 #
-writer = StateMachine(0, neopixel_write, freq=4_800_000, out_base=Pin(12), set_base=Pin(12))
+SM_FREQ = const(2_400_000)
+writer = StateMachine(0, neopixel_write, freq=SM_FREQ, sideset_base=Pin(12))
 writer.active(1)
+writer.put(NUM_LEDS - 1)
+
+# State machine cycles per pixel: 3 per bit, plus pull() and jmp(y_dec)
+PIXEL_CYCLES = const(24 * 3 + 2)
+# State machine cycles per frame after the last pixel: set(x), the latch
+# loop, jmp("frame") and mov(y)
+LATCH_CYCLES = const(1 + 32 * 4 + 1 + 1)
+
+# How long the state machine takes to send a whole frame to the strip,
+# including the delay so the pixels latch.  This is the frame period when
+# frames are sent back to back.
+FRAME_US = const((NUM_LEDS * PIXEL_CYCLES + LATCH_CYCLES) * 1_000_000 // SM_FREQ)
+
+# The joined TX FIFO holds 8 words (pixels)
+FIFO_DEPTH = const(8)
+
+# When frames are sent back to back, the DMA finishes reading a frame about
+# FRAME_US after it started, less the time the caller took between frames.
+# show() sleeps for FRAME_US less this slack (two pixels), then polls for the
+# last moment.  If the DMA finishes sooner (e.g. the FIFO was empty when it
+# started), sleeping past it is harmless: the whole frame is already queued.
+SHOW_SLACK_US = const(2 * PIXEL_CYCLES * 1_000_000 // SM_FREQ)
+
+#
+# A DMA channel copies a frame to the state machine's TX FIFO, one word each time
+# the PIO asks for more data (DREQ).
+#
+PIO0_TXF0 = 0x50200010      # Address of PIO0's TX FIFO for state machine 0
+DREQ_PIO0_TX0 = const(0)    # DREQ for PIO0's TX FIFO for state machine 0
+dma = rp2.DMA()
+DMA_CTRL = dma.pack_ctrl(size=2, inc_write=False, treq_sel=DREQ_PIO0_TX0)
+
+def show(frame):
+    """
+    Send a frame (a buffer of NUM_LEDS 32-bit words) to the strip.  The DMA
+    channel feeds the FIFO while we sleep.  Returns once the DMA has read
+    the whole frame (not once the frame has been shifted out), so `frame`
+    may be changed again, and the DMA channel is free for the next frame.
+    At that point, the last FIFO_DEPTH pixels are still in the FIFO, so the
+    caller has that long (plus the latch delay) to start the next frame
+    without the state machine running out of data.
+    """
+    if len(frame) < NUM_LEDS:
+        raise ValueError("frame must have at least NUM_LEDS words")
+    dma.config(read=frame, write=PIO0_TXF0, count=NUM_LEDS, ctrl=DMA_CTRL, trigger=True)
+
+    # Sleep until just before the transfer is done, then wait for the rest
+    time.sleep_us(FRAME_US - SHOW_SLACK_US)
+    while dma.active():
+        pass
 
-NUM_LEDS=90
+#
+# A color wheel with 45 GRBx 32-bit colors, at brightness 63 (out of 255).
+#   0-14 is green-red:  red = offset * 63 // 14, green = 63 - red
+#  15-29 is red-blue:   blue = (offset - 15) * 63 // 14, red = 63 - blue
+#  30-44 is blue-green: green = (offset - 30) * 63 // 14, blue = 63 - green
+# Each color is green << 24 | red << 16 | blue << 8.
+#
+_WHEEL = (
+    0x3f000000, 0x3b040000, 0x36090000, 0x320d0000, 0x2d120000,
+    0x29160000, 0x241b0000, 0x201f0000, 0x1b240000, 0x17280000,
+    0x122d0000, 0x0e310000, 0x09360000, 0x053a0000, 0x003f0000,
+    0x003f0000, 0x003b0400, 0x00360900, 0x00320d00, 0x002d1200,
+    0x00291600, 0x00241b00, 0x00201f00, 0x001b2400, 0x00172800,
+    0x00122d00, 0x000e3100, 0x00093600, 0x00053a00, 0x00003f00,
+    0x00003f00, 0x04003b00, 0x09003600, 0x0d003200, 0x12002d00,
+    0x16002900, 0x1b002400, 0x1f002000, 0x24001b00, 0x28001700,
+    0x2d001200, 0x31000e00, 0x36000900, 0x3a000500, 0x3f000000,
+)
 
 def color_wheel(offset, brightness=255):
-    "Convert an offset (0-44, inclusive) to a GRBx 32-bit color"
+    """
+    Convert an offset (0-44, inclusive) to a GRBx 32-bit color.  Brightness
+    63 (used for the rainbow) comes from the table; other brightnesses are
+    computed.
+    """
+    if brightness == 63:
+        return _WHEEL[offset]
+
     green = 0
     red = 0
     blue = 0
@@ -77,48 +191,125 @@ def color_wheel(offset, brightness=255):
         green = (offset - 30) * brightness // 14
         blue = brightness - green
     
-    # print("offset: {0}, red: {1}, green: {2}, blue: {3}".format(offset, red, green, blue))
     return green << 24 | red << 16 | blue << 8
 
-colors = [color_wheel(i, 63) for i in range(45)]    # A rainbow: one of each color
+# The colors are stored as an array of 32-bit words (not a list of int objects),
+# so they can be sent to the FIFO as is.
+colors = array('I', _WHEEL)    # A rainbow: one of each color
 colors = colors + colors    # Repeat the rainbow twice for the whole strip
 
+# How rainbow_wave() makes one LED brighter: color << 2 | _DIM_BOOST
+_DIM_BOOST = const(0x33333300)
+
+# The frame that the animations send to the strip, and a frame with all LEDs
+# off.  Animations reset `frame` with slice assignment (a single copy of
+# NUM_LEDS words), then only change the lit LED each update.
+ALL_OFF = array('I', bytes(4 * NUM_LEDS))
+frame = array('I', ALL_OFF)
+
+@micropython.viper
+def _chase(frame, color: int, reverse: bool):
+    """
+    The inner loop of single_chase(): light LED #i with `color`, send the
+    frame, then turn LED #i off again, for each LED in turn.  `frame` must
+    already be all off.  Like _sweep(), the positions are native integers,
+    so each update is just two stores and a call to show().
+    """
+    buf = ptr32(frame)
+    i = 0
+    step = 1
+    if reverse:
+        i = NUM_LEDS - 1
+        step = -1
+    for count in range(NUM_LEDS):
+        # Set LED #i to the given color, and all others off.
+        buf[i] = color
+        show(frame)
+        buf[i] = 0
+        i += step
+
 def single_chase(color, reverse=False):
     """
     Light up one LED at a time, using the given color.  All other LEDs
     will be off.  By default, it goes from offset 0 to NUM_LEDS-1.
     If the `reverse` argument is true, it will go in the opposite direction.
     """
-    # The order that the LEDs will light
-    on_offsets = range(NUM_LEDS)
-    if reverse:
-        on_offsets = reversed(on_offsets)
-    
-    for offset in on_offsets:
-        # Set LED #offset to the given color, and all others off.
-        for i in range(NUM_LEDS):
-            if i == offset:
-                writer.put(color)
-            else:
-                writer.put(0)
-        
-        # Wait for the PIO state machine to consume all of the data we've
-        # given it, then delay 50us so the NeoPixels know we are done.
-        while writer.tx_fifo() > 0:
-            pass
-        time.sleep_us(50)
+    # All LEDs off.  Only the lit LED is changed (and then restored) each frame.
+    frame[:] = ALL_OFF
+    _chase(frame, color, reverse)
+
+# The colors for back_and_forth_chasers()
+CHASE_COLORS = array('I', [0x003f0000, 0x3f3f0000, 0x3f000000, 0x3f003f00, 0x00003f00, 0x003f3f00, 0x3f3f3f00])
 
 def back_and_forth_chasers():
-    for color in [0x003f0000, 0x3f3f0000, 0x3f000000, 0x3f003f00, 0x00003f00, 0x003f3f00, 0x3f3f3f00]:
+    for color in CHASE_COLORS:
         single_chase(color)
         single_chase(color, reverse=True)
 
-def sliding_rainbow(colors, times=5):
+def sliding_rainbow(colors, times=5, delay_ms=100):
+    """
+    Rotate the colors along the strip, one spot per update.  `delay_ms` is
+    the delay between updates, which slows the animation.  If it is 0, the
+    strip is updated as fast as the frames can be sent.
+    """
+    # The colors, repeated to fill NUM_LEDS more spots than there are colors.
+    # Each frame is a window of NUM_LEDS colors into this buffer, starting one
+    # spot further to the right, so the colors appear to rotate one spot to the
+    # left without copying them.  Every window is a whole frame, no matter how
+    # many colors there are.  The windows are sliced once, so the animation
+    # itself doesn't allocate.
+    num_colors = len(colors)
+    ring = memoryview(array('I', (colors[i % num_colors] for i in range(num_colors + NUM_LEDS))))
+    windows = [ring[offset:offset + NUM_LEDS] for offset in range(num_colors)]
     for n in range(NUM_LEDS * times):
-        for color in colors:
-            writer.put(color)
-        colors = colors[1:] + colors[0:1]   # Rotate the colors one spot to the left
-        time.sleep_ms(100)  # Delay between updates, and slow the animation
+        show(windows[n % num_colors])
+        if delay_ms:
+            time.sleep_ms(delay_ms)
+
+@micropython.viper
+def _sweep(frame, colors, bright: bool, reverse: bool):
+    """
+    Move one lit LED along the strip, from start to end (or end to start if
+    `reverse` is true).  While LED #i is lit, it shows colors[i], or a
+    brighter version of it if `bright` is true.  Afterwards, it is restored
+    to whatever `frame` held before.
+
+    This is the inner loop of rainbow_chaser() and rainbow_wave().  Viper
+    compiles it to native integer code, so only show() goes through the
+    interpreter.  There is no delay between updates.  The animation is
+    paced by show(), which waits for the DMA to finish reading each frame
+    before returning, so a transfer is never restarted while it is running.
+    """
+    buf = ptr32(frame)
+    lit = ptr32(colors)
+    i = 0
+    step = 1
+    if reverse:
+        i = NUM_LEDS - 1
+        step = -1
+    for count in range(NUM_LEDS):
+        # Update all of the LEDs in the strip, with LED #i lit.
+        old = buf[i]
+        if bright:
+            buf[i] = lit[i] << 2 | _DIM_BOOST
+        else:
+            buf[i] = lit[i]
+        show(frame)
+        buf[i] = old
+        i += step
+
+def _sweep_colors(colors):
+    """
+    Check the colors passed to rainbow_chaser() or rainbow_wave(), and return
+    them as an array of 32-bit words for _sweep().  Viper doesn't check bounds,
+    so there must be at least NUM_LEDS colors.  A list (or other sequence) is
+    copied into an array once, here, rather than in the animation.
+    """
+    if len(colors) < NUM_LEDS:
+        raise ValueError("colors must have at least NUM_LEDS words")
+    if not isinstance(colors, array):
+        colors = array('I', colors)
+    return colors
 
 def rainbow_chaser(colors, times=10):
     """
@@ -126,54 +317,50 @@ def rainbow_chaser(colors, times=10):
     like back_and_forth_chasers, except that the color depends on the position
     in the strip.
     """
+    colors = _sweep_colors(colors)
+
+    # All LEDs off.  Only the lit LED is changed (and then restored) each frame.
+    frame[:] = ALL_OFF
+
     for n in range(times):
-        for i in range(NUM_LEDS):
-            # i is the index of the LED that will be lit during this iteration
-
-            # Update all of the LEDs in the strip.
-            for j in range(NUM_LEDS):
-                if i == j:
-                    writer.put(colors[j])
-                else:
-                    writer.put(0)
-            time.sleep_us(500)  # Delay between updates, and slow the animation
+        _sweep(frame, colors, False, False)
         
         # Do the same thing, backwards
-        for i in reversed(range(NUM_LEDS)):
-            for j in range(NUM_LEDS):
-                if i == j:
-                    writer.put(colors[j])
-                else:
-                    writer.put(0)
-            time.sleep_us(500)
+        _sweep(frame, colors, False, True)
 
 def rainbow_wave(colors, times=10):
     """
     Similar to rainbow_chaser(), except that all LEDs are on (in a rainbow),
     and one will be brighter.  The brighter one moves back and forth.
     """
-    dim_colors = colors[:]
-    bright_colors = [color << 2 | 0x33333300 for color in colors]
+    colors = _sweep_colors(colors)
+
+    # The frame always holds the colors, except for the one bright LED,
+    # which is restored after it is sent.  Copy exactly NUM_LEDS words, since
+    # slice assignment would resize `frame` to the length of `colors`.
+    frame[:] = memoryview(colors)[:NUM_LEDS]
 
     for n in range(times):
-        for i in range(NUM_LEDS):
-            for j in range(NUM_LEDS):
-                if i == j:
-                    writer.put(bright_colors[j])
-                else:
-                    writer.put(dim_colors[j])
-            time.sleep_us(500)
-        for i in reversed(range(NUM_LEDS)):
-            for j in range(NUM_LEDS):
-                if i == j:
-                    writer.put(bright_colors[j])
-                else:
-                    writer.put(dim_colors[j])
-            time.sleep_us(500)
-
-# Do the rainbow chaser the default number of times
-rainbow_chaser(colors)
-
-# Turn off all the LEDs
-for i in range(NUM_LEDS):
-    writer.put(0)
+        _sweep(frame, colors, True, False)
+        _sweep(frame, colors, True, True)
+
+# Do the rainbow chaser the default number of times.  The animations don't
+# allocate any memory once they start, so the garbage collector is turned off
+# while they run, and the free memory must be the same afterwards.  Whatever
+# happens (including Ctrl-C), turn the collector back on and the LEDs off.
+gc.collect()
+gc.disable()
+try:
+    free_before = gc.mem_free()
+    rainbow_chaser(colors)
+    assert gc.mem_free() == free_before, "Animation allocated memory"
+    del free_before
+finally:
+    gc.enable()
+
+    # Turn off all the LEDs.  If the animation was interrupted in show(),
+    # let its transfer finish first.
+    while dma.active():
+        pass
+    frame[:] = ALL_OFF
+    show(frame)
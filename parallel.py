@@ -1,5 +1,6 @@
 import time
 import rp2
+from array import array
 from rp2 import PIO
 from machine import Pin
 
@@ -60,9 +61,14 @@ def parallel_delayed_clock():
 writer = rp2.StateMachine(0, parallel, freq=2_000, out_base=Pin(2), sideset_base=Pin(1))
 writer.active(1)
 
-# Cycle through all 8-bit values, with a brief delay to make the values visible
-for i in range(256):
-    writer.put(int(i))
+# All 8-bit values, as a buffer of 32-bit words for the FIFO
+ramp = array('I', range(256))
+
+# Cycle through all 8-bit values, with a brief delay to make the values visible.
+# At higher state machine frequencies, drop the delay and send all of the
+# values with a single call: writer.put(ramp)
+for i in ramp:
+    writer.put(i)
     time.sleep_ms(50)
 
 # Pause for 1 second with all of the data LEDs on